@@ -31,8 +31,9 @@ Helper tool to show bcache hierarchy
 
 
 import argparse
-import glob
+import concurrent.futures
 import os
+import sys
 
 
 def argparser():
@@ -65,15 +66,35 @@ def argparser():
     return r
 
 
+def _read_small(path):
+    """Return the stripped contents of a small sysfs attribute file"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, 256).decode("ascii", "replace").strip()
+    finally:
+        os.close(fd)
+
+
+def _read_backing_dev(path):
+    """Return the name and uuid of the backing device for a bdev"""
+    backing = path + "/backing_dev_"
+    return _read_small(backing + "name"), _read_small(backing + "uuid")
+
+
 class Trie:
     """Implement a Trie structure
 
+    Chains of nodes with only one child are collapsed into a single edge
+    (a radix tree), so there is one node per branch point rather than one
+    per character.  Each edge is stored keyed by its first char as a tuple
+    of (label, child), with a child of None marking the end of a key.
+
     >>> t = Trie()
     >>> t.insert("larry")
     >>> t.insert("moe")
     >>> t.insert("curly")
 
-    >>> len(t.children) == 3
+    >>> len(t.edges) == 3
     True
 
     >>> sorted(t.prefixes())
@@ -95,25 +116,63 @@ class Trie:
     >>> sorted(found[1].prefixes())
     ['l', 'u']
 
-    >>> t.find("z")
-    False
+    >>> t.find("z") is None
+    True
 
     """
 
+    __slots__ = ("edges",)
+
     def __init__(self):
-        self.children = {}
+        self.edges = {}
 
     def insert(self, key):
-        """Insert a new key into the Trie"""
-        ch = key[0]
-        if ch not in self.children:
-            self.children[ch] = Trie()
+        """Insert a new key into the Trie
 
-        if len(key) > 1:
-            self.children[ch].insert(key[1:])
+        >>> t = Trie()
+        >>> t.insert("abc")
+        >>> t.insert("abd")
+        >>> t.insert("ab")
+        >>> t.insert("abcde")
+        >>> label, child = t.edges["a"]
+        >>> label
+        'ab'
+        >>> sorted(child.edges.values(), key=lambda edge: edge[0])
+        [('cde', None), ('d', None)]
+        """
+        node = self
+        while key:
+            ch = key[0]
+            if ch not in node.edges:
+                node.edges[ch] = (key, None)
+                return
+
+            label, child = node.edges[ch]
+            common = len(os.path.commonprefix((label, key)))
+
+            if common < len(label):
+                if common == len(key):
+                    # The key is already covered by this edge
+                    return
+
+                # Split the edge at the point where they differ
+                split = Trie()
+                split.edges[label[common]] = (label[common:], child)
+                split.edges[key[common]] = (key[common:], None)
+                node.edges[ch] = (label[:common], split)
+                return
+
+            key = key[common:]
+            if child is None:
+                # Extend the end of an existing key
+                if key:
+                    node.edges[ch] = (label + key, None)
+                return
+
+            node = child
 
     def find(self, key):
-        """Given a unique prefix, return the full value
+        """Given a unique prefix, return the full value, or None if no match
 
         >>> t = Trie()
         >>> t.insert("ab1")
@@ -126,52 +185,38 @@ class Trie:
         >>> sorted(found[1].prefixes())
         ['1', '2']
         """
-        # We are now just looking for the full key
-        if key is None:
-            # .. this is the final depth
-            if len(self.children) == 0:
-                return ''
-
-            # .. and are there are multiple matches?
-            if len(self.children) > 1:
-                return ('', self)
-
-            # Recurse deeper
-            ch, child = list(self.children.items())[0]
-            tail = child.find(key)
-            if isinstance(tail, str):
-                return ch + tail
-            if isinstance(tail, bool):
-                return tail
-
-            child = tail[1]
-            tail = tail[0]
-
-            return (ch + tail, child)
-
-        ch = key[0]
-        if ch not in self.children:
-            # A failed find
-            return False
+        node = self
+        found = ""
+        while key:
+            if key[0] not in node.edges:
+                # A failed find
+                return None
 
-        child = self.children[ch]
+            label, node = node.edges[key[0]]
+            if not label.startswith(key[:len(label)]):
+                return None
 
-        # is this is the last char of the search key?
-        if len(key) == 1:
-            tail = child.find(None)
-        else:
-            tail = child.find(key[1:])
+            found += label
+            key = key[len(label):]
 
-        if isinstance(tail, str):
-            return ch + tail
+            if node is None:
+                if key:
+                    return None
+                return found
 
-        if isinstance(tail, bool):
-            return tail
+        # We are now just looking for the full key
+        while len(node.edges) == 1:
+            label, node = next(iter(node.edges.values()))
+            found += label
+            if node is None:
+                # .. this is the final depth
+                return found
 
-        child = tail[1]
-        tail = tail[0]
+        # .. and are there are multiple matches?
+        if len(node.edges) > 1:
+            return (found, node)
 
-        return (ch + tail, child)
+        return found
 
     def shorten(self, key, minlen=1):
         """Given a full value, return the unique prefix
@@ -191,63 +236,177 @@ class Trie:
 
         >>> t.shorten("12345678")
         '12345'
+
+        >>> t.insert("12345679")
+        >>> t.shorten("12345678")
+        '12345678'
+        >>> t.shorten("1234abcd")
+        '1234a'
         """
 
-        items = []
-        this = self
-        while len(items) < len(key):
-            ch = key[len(items)]
-            if ch not in this.children:
+        # Walk down once, remembering the deepest branch passed through
+        node = self
+        depth = 0
+        last_branch = 0
+        while depth < len(key):
+            if node is None:
                 return False
-            this = this.children[ch]
-            items.append(this)
+
+            if depth and len(node.edges) > 1:
+                last_branch = depth
+
+            edge = node.edges.get(key[depth])
+            if edge is None:
+                return False
+
+            label, node = edge
+            if not key.startswith(label, depth):
+                return False
+            depth += len(label)
 
         # The key didnt find one complete item
-        if len(items[-1].children):
+        if node is not None:
             return False
 
-        offset = len(items) - 2
-        while offset >= 0:
-            if len(items[offset].children) == 1:
-                offset -= 1
-            else:
-                offset += 2
-                if offset < minlen:
-                    offset = minlen
-                return key[:offset]
+        if last_branch:
+            return key[:max(last_branch + 1, minlen)]
 
         # We never had a collision, so the key is unique at the start
         return key[0:minlen]
 
-    def prefixes(self, prefix=None, minlen=0):
+    def prefixes(self, minlen=0):
         """Return a list of unique prefixes"""
-        if prefix is None:
-            prefix = ""
+        found = set()
+        self._prefixes_into(found, [], 0, minlen)
+        return found
+
+    def _prefixes_into(self, found, stack, depth, minlen):
+        """Add the unique prefixes below this node to the found set
 
-        if len(self.children) == 0:
+        The labels of the edges walked to get here are kept on the stack
+        and are only joined into a string when a prefix is emitted.
+        """
+        if len(self.edges) == 0:
             # definitely terminal
-            return set([prefix])
+            found.add("".join(stack))
+            return
 
-        if len(self.children) == 1:
+        if len(self.edges) == 1:
             # dont return if we need more chars
-            if len(prefix) >= minlen:
-                return set([prefix])
+            if depth >= minlen:
+                found.add("".join(stack))
+                return
+
+        for label, child in self.edges.values():
+            # The shortest prefix that is no longer at a branch point
+            need = max(1, minlen - depth)
+            if need < len(label) or child is None:
+                found.add("".join(stack) + label[:need])
+                continue
 
-        found = set()
-        for ch, v in self.children.items():
-            found.update(v.prefixes(prefix + ch, minlen=minlen))
+            stack.append(label)
+            child._prefixes_into(found, stack, depth + len(label), minlen)
+            stack.pop()
 
-        return found
+
+class UniquePrefix:
+    """Find the shortest unique prefix for each of a set of keys
+
+    Once the keys are sorted, each one shares the most leading chars with
+    its neighbours, so its unique prefix is one char longer than the
+    longest common prefix with either of them.
+
+    >>> u = UniquePrefix()
+    >>> u.insert("12345678")
+
+    >>> u.shorten("12345678")
+    '1'
+    >>> u.shorten("12345678", minlen=2)
+    '12'
+
+    >>> u.insert("1234abcd")
+
+    >>> u.shorten("12345")
+    False
+
+    >>> u.shorten("12345678")
+    '12345'
+
+    >>> u.insert("12345679")
+    >>> u.shorten("12345678")
+    '12345678'
+    >>> u.shorten("1234abcd")
+    '1234a'
+
+    >>> u.insert("1234")
+    >>> u.shorten("1234")
+    False
+    """
+
+    __slots__ = ("keys", "shortlen")
+
+    def __init__(self):
+        self.keys = set()
+        # The length needed for each key, calculated on the next shorten
+        self.shortlen = None
+
+    def insert(self, key):
+        """Add a new key"""
+        if key not in self.keys:
+            self.keys.add(key)
+            self.shortlen = None
+
+    def _update(self):
+        keys = sorted(self.keys)
+
+        # A key that only prefixes a longer one has no unique prefix
+        keys = [
+            key for key, after in zip(keys, keys[1:] + [""])
+            if not after.startswith(key)
+        ]
+
+        self.shortlen = {}
+        prev = 0
+        for i, key in enumerate(keys):
+            if i + 1 < len(keys):
+                common = len(os.path.commonprefix((key, keys[i + 1])))
+            else:
+                common = 0
+
+            self.shortlen[key] = max(prev, common) + 1
+            prev = common
+
+    def shorten(self, key, minlen=1):
+        """Given a full value, return the unique prefix"""
+        if self.shortlen is None:
+            self._update()
+
+        length = self.shortlen.get(key)
+        if length is None:
+            return False
+        return key[:max(length, minlen)]
 
 
 class Bcache:
-    ids = Trie()
+    __slots__ = (
+        "path",
+        "type",
+        "_id",
+        "_parent",
+        "_id_short",
+        "_parent_short",
+    )
+
+    ids = UniquePrefix()
 
     def __init__(self):
         self.path = None
         self.type = None
         self._id = None
         self._parent = None
+        # Cached results of shortening the ids, filled in on first use
+        self._id_short = None
+        self._parent_short = None
 
     def __str__(self):
         # TODO:
@@ -263,87 +422,111 @@ class Bcache:
     def id(self):
         if self._id is None:
             return str(self._id)
-        return self.ids.shorten(self._id, minlen=4)
+        if self._id_short is None:
+            self._id_short = self.ids.shorten(self._id, minlen=4)
+        return self._id_short
 
     @id.setter
     def id(self, val):
         self._id = val
-        self.ids.insert(val)
+        self._id_short = None
+        if val:
+            self.ids.insert(val)
 
     @property
     def parent(self):
         if self._parent is None:
             return str(self._parent)
-        return self.ids.shorten(self._parent, minlen=4)
+        if self._parent_short is None:
+            self._parent_short = self.ids.shorten(self._parent, minlen=4)
+        return self._parent_short
 
     @parent.setter
     def parent(self, val):
         self._parent = val
-        self.ids.insert(val)
+        self._parent_short = None
+        if val:
+            self.ids.insert(val)
 
     @classmethod
     def _find_fs_bcache(cls):
         objects = []
-        os.chdir("/sys/fs/bcache")
-        files = glob.glob("*")
-        for file in files:
-            if not os.path.isdir(file):
-                continue
+        pending = []
+        base = "/sys/fs/bcache"
+        with os.scandir(base) as entries:
+            csets = [entry for entry in entries if entry.is_dir()]
 
+        for cset in csets:
             obj = cls()
             obj.type = "cset"
-            obj.id = file
+            obj.id = cset.name
 
-            if os.path.islink(f"{file}/bdev0/dev"):
-                obj.path = os.readlink(f"{file}/bdev0/dev").split("/")[-1]
+            dev = f"{cset.path}/bdev0/dev"
+            if os.path.islink(dev):
+                obj.path = os.readlink(dev).split("/")[-1]
 
             objects.append(obj)
 
-            for bdev in glob.glob(f"{file}/bdev*"):
-                if not os.path.islink(bdev):
-                    continue
+            # Classify the cset contents with a single directory read
+            bdevs = []
+            caches = []
+            with os.scandir(cset.path) as entries:
+                for entry in entries:
+                    if not entry.is_symlink():
+                        continue
+                    if entry.name.startswith("bdev"):
+                        bdevs.append(entry)
+                    elif entry.name.startswith("cache"):
+                        caches.append(entry)
+
+            for bdev in bdevs:
                 obj = cls()
-                obj.type = bdev.split("/")[-1]
-                obj.parent = file
-                with open(f"{bdev}/backing_dev_name") as f:
-                    obj.path = f.readline().strip()
-                with open(f"{bdev}/backing_dev_uuid") as f:
-                    obj.id = f.readline().strip()
+                obj.type = bdev.name
+                obj.parent = cset.name
+                pending.append((obj, bdev.path))
                 objects.append(obj)
 
-            for cache in glob.glob(f"{file}/cache*"):
-                if not os.path.islink(cache):
-                    continue
+            for cache in caches:
                 obj = cls()
-                obj.type = cache.split("/")[-1]
-                obj.parent = file
-                obj.path = os.readlink(cache).split("/")[-2]
+                obj.type = cache.name
+                obj.parent = cset.name
+                obj.path = os.readlink(cache.path).split("/")[-2]
                 # TODO: how to get cache uuid without reading the superblock?
                 obj.id = "Null"
                 objects.append(obj)
 
+        # The bdev details are independent reads, so overlap them
+        if pending:
+            paths = [path for obj, path in pending]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as ex:
+                results = ex.map(_read_backing_dev, paths)
+                for (obj, path), (name, uuid) in zip(pending, results):
+                    obj.path = name
+                    obj.id = uuid
+
         return objects
 
     @classmethod
     def _find_block(cls):
         objects = []
-        os.chdir("/sys/class/block")
-        files = glob.glob("*")
-        for file in files:
-            if not os.path.exists(f"{file}/bcache"):
-                continue
+        base = "/sys/class/block"
+        with os.scandir(base) as entries:
+            for entry in entries:
+                bcache = f"{entry.path}/bcache"
+                if not os.path.exists(bcache):
+                    continue
+
+                if os.path.islink(bcache):
+                    obj = cls()
+                    obj.type = "cset"
+                    obj.path = entry.name
+                    objects.append(obj)
+                    continue
 
-            if os.path.islink(f"{file}/bcache"):
                 obj = cls()
-                obj.type = "cset"
-                obj.path = file
+                obj.type = "unk"
+                obj.path = entry.name
                 objects.append(obj)
-                continue
-
-            obj = cls()
-            obj.type = "unk"
-            obj.path = file
-            objects.append(obj)
 
         return objects
 
@@ -374,22 +557,26 @@ def main():
             parents.append(i)
             continue
 
-        if i.parent not in children:
-            children[i.parent] = []
+        # Group by the full id, which avoids shortening it
+        if i._parent not in children:
+            children[i._parent] = []
 
-        children[i.parent].append(i)
+        children[i._parent].append(i)
 
+    # Collect the whole tree so it can be output with a single write
+    lines = []
     for parent in parents:
-        print(parent)
-        nr = len(children[parent.id])
-        for child in children[parent.id]:
-            if nr == 1:
-                prefix = "└─"
-            else:
-                prefix = "├─"
-            nr -= 1
+        lines.append(str(parent))
+        kids = children.get(parent._id)
+        if not kids:
+            continue
+
+        for child in kids[:-1]:
+            lines.append(f"├─ {child}")
+        lines.append(f"└─ {kids[-1]}")
 
-            print(prefix, child)
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
 
     # print(yaml.dump(Bcache.ids))
 
@@ -412,7 +599,7 @@ def main():
     #         print(found)
     #         return
 
-    #     if isinstance(found, bool):
+    #     if found is None:
     #         print(found)
     #         return
 